@@ -59,14 +59,14 @@ def driver(pos, mesh, weights, mode, period, transform,
         p[...] = period
         period = p
 
+    if numpy.isscalar(weights):
+        # zero-stride view; a scalar weight is never materialized per particle
+        weights = numpy.broadcast_to(numpy.float64(weights), (Np,))
+
     for start in range(0, Np, chunksize):
         chunk = slice(start, start+chunksize)
         mypos = transform(pos[chunk])
-        if numpy.isscalar(weights):
-            wchunk = numpy.empty(chunksize)
-            wchunk[:] = weights
-        else:
-            wchunk = weights[chunk]
+        wchunk = weights[chunk]
         if callback(mypos, mesh, mesh.ravel(), wchunk, period) \
                 and mode == "raise":
            raise ValueError("Some points are out of boundary")
@@ -152,3 +152,86 @@ def readout_some(pos, mesh, meshflat, myvalue, period):
             tmp += meshflat[ind] * kernel
         myvalue[i] = tmp
     return outbound
+
+# kernels specialized for a fixed 3d period, keyed by the period.
+_kernels3d = {}
+
+def kernels3d(period):
+    """ Build (or fetch from cache) paint and readout kernels for 3d meshes
+        with a fixed period; the period is a compile time constant of the kernels.
+
+        The kernels transform pos to mesh units with pos * scale - offset
+        on the fly. They return the number of ignored contributions.
+
+        paint(pos, meshflat, shape, weights, scale, offset)
+        readout(pos, meshflat, shape, out, scale, offset)
+    """
+    period = int(period)
+    if period in _kernels3d:
+        return _kernels3d[period]
+
+    N = period
+
+    @numba.jit(nopython=True)
+    def paint(pos, meshflat, shape, weights, scale, offset):
+        outbound = 0
+        for i in range(pos.shape[0]):
+            x = pos[i, 0] * scale[0] - offset[0]
+            y = pos[i, 1] * scale[1] - offset[1]
+            z = pos[i, 2] * scale[2] - offset[2]
+            ix = int(math.floor(x))
+            iy = int(math.floor(y))
+            iz = int(math.floor(z))
+            dx = x - ix
+            dy = y - iy
+            dz = z - iz
+            w = weights[i]
+            for n in range(8):
+                rx = n & 1
+                ry = (n >> 1) & 1
+                rz = (n >> 2) & 1
+                tx = (ix + rx) % N
+                ty = (iy + ry) % N
+                tz = (iz + rz) % N
+                if tx >= shape[0] or ty >= shape[1] or tz >= shape[2]:
+                    outbound += 1
+                    continue
+                kernel = (dx if rx else 1.0 - dx) \
+                       * (dy if ry else 1.0 - dy) \
+                       * (dz if rz else 1.0 - dz)
+                meshflat[(tx * shape[1] + ty) * shape[2] + tz] += w * kernel
+        return outbound
+
+    @numba.jit(nopython=True)
+    def readout(pos, meshflat, shape, out, scale, offset):
+        outbound = 0
+        for i in range(pos.shape[0]):
+            x = pos[i, 0] * scale[0] - offset[0]
+            y = pos[i, 1] * scale[1] - offset[1]
+            z = pos[i, 2] * scale[2] - offset[2]
+            ix = int(math.floor(x))
+            iy = int(math.floor(y))
+            iz = int(math.floor(z))
+            dx = x - ix
+            dy = y - iy
+            dz = z - iz
+            tmp = 0.0
+            for n in range(8):
+                rx = n & 1
+                ry = (n >> 1) & 1
+                rz = (n >> 2) & 1
+                tx = (ix + rx) % N
+                ty = (iy + ry) % N
+                tz = (iz + rz) % N
+                if tx >= shape[0] or ty >= shape[1] or tz >= shape[2]:
+                    outbound += 1
+                    continue
+                kernel = (dx if rx else 1.0 - dx) \
+                       * (dy if ry else 1.0 - dy) \
+                       * (dz if rz else 1.0 - dz)
+                tmp += meshflat[(tx * shape[1] + ty) * shape[2] + tz] * kernel
+            out[i] = tmp
+        return outbound
+
+    _kernels3d[period] = (paint, readout)
+    return paint, readout
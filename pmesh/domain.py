@@ -46,37 +46,86 @@ class Layout(object):
 
     Useful methods are :py:meth:`exchange`, and :py:meth:`gather`.
 
+    A Layout created with :code:`nonblocking=True` has not finished
+    collecting the receive counts; :py:meth:`wait` completes it, and is called
+    implicitly by :py:meth:`exchange`, :py:meth:`gather`, and when
+    :code:`recvcounts`, :code:`sendoffsets`, :code:`recvoffsets` or
+    :code:`newlength` are read.
+
     """
-    def __init__(self, comm, oldlength, sendcounts, indices, recvcounts=None):
+    def __init__(self, comm, oldlength, sendcounts, indices, recvcounts=None, nonblocking=False):
         """
         sendcounts is the number of items to send
         indices is the indices of the items in the data array.
+        if nonblocking, the exchange of counts is posted but not waited for.
         """
 
         self.comm = comm
         assert self.comm.size == sendcounts.shape[0]
 
         self.sendcounts = numpy.array(sendcounts, order='C')
-        self.recvcounts = numpy.empty_like(self.sendcounts, order='C')
+        self._recvcounts = numpy.empty_like(self.sendcounts, order='C')
 
-        self.sendoffsets = numpy.zeros_like(self.sendcounts, order='C')
-        self.recvoffsets = numpy.zeros_like(self.recvcounts, order='C')
+        self._sendoffsets = numpy.zeros_like(self.sendcounts, order='C')
+        self._recvoffsets = numpy.zeros_like(self._recvcounts, order='C')
+
+        self.oldlength = oldlength
+        self.indices = indices
+        self._request = None
 
         if recvcounts is None:
             # calculate the recv counts array
             # ! Alltoall
+            if nonblocking:
+                self._request = self.comm.Ialltoall(self.sendcounts, self._recvcounts)
+                return
             self.comm.Barrier()
-            self.comm.Alltoall(self.sendcounts, self.recvcounts)
+            self.comm.Alltoall(self.sendcounts, self._recvcounts)
             self.comm.Barrier()
         else:
-            self.recvcounts = recvcounts
-        self.sendoffsets[1:] = self.sendcounts.cumsum()[:-1]
-        self.recvoffsets[1:] = self.recvcounts.cumsum()[:-1]
+            self._recvcounts = recvcounts
+        self._finish()
 
-        self.oldlength = oldlength
-        self.newlength = self.recvcounts.sum()
+    def _finish(self):
+        self._sendoffsets[1:] = self.sendcounts.cumsum()[:-1]
+        self._recvoffsets[1:] = self._recvcounts.cumsum()[:-1]
 
-        self.indices = indices
+        self._newlength = self._recvcounts.sum()
+
+    # the following depend on the exchange of counts; reading them
+    # waits for a nonblocking layout to complete.
+    @property
+    def recvcounts(self):
+        return self.wait()._recvcounts
+
+    @property
+    def sendoffsets(self):
+        return self.wait()._sendoffsets
+
+    @property
+    def recvoffsets(self):
+        return self.wait()._recvoffsets
+
+    @property
+    def newlength(self):
+        return self.wait()._newlength
+
+    def wait(self):
+        """ 
+        Wait for the exchange of counts posted by a nonblocking layout.
+
+        Does nothing if the layout is already complete.
+
+        Returns
+        -------
+        layout : :py:class:`Layout`
+            the layout itself
+        """
+        if self._request is not None:
+            self._request.Wait()
+            self._request = None
+            self._finish()
+        return self
 
     def exchange(self, data):
         """ 
@@ -98,6 +147,7 @@ class Layout(object):
             Refer to :py:meth:`gather` for collecting data of ghosts.
 
         """
+        self.wait()
         # first convert to array
         data = promote(data, self.comm)
 
@@ -158,6 +208,7 @@ class Layout(object):
             all gathered particles (corresponding to self.indices) are returned.
         
         """
+        self.wait()
         data = promote(data, self.comm)
         # lets check the data type first
 
@@ -247,7 +298,9 @@ class GridND(object):
         if len(data) == 0:
             return numpy.empty((0), dtype='intp')
         else:
-            return numpy.digitize(data, bins)
+            # same as numpy.digitize for increasing bins, without
+            # the monotonicity check on every call.
+            return numpy.searchsorted(bins, data, side='right')
 
     @classmethod
     def uniform(cls, BoxSize, comm=MPI.COMM_WORLD, periodic=True):
@@ -279,6 +332,8 @@ class GridND(object):
         self.shape = numpy.array([len(g) - 1 for g in edges], dtype='int32')
         self.ndim = len(self.shape)
         self.edges = numpy.asarray(edges)
+        # contiguous per-direction edges, used by decompose
+        self._edges = [numpy.ascontiguousarray(g, dtype='f8') for g in edges]
         self.periodic = periodic
         self.comm = comm
         assert comm.size >= numpy.product(self.shape)
@@ -292,7 +347,7 @@ class GridND(object):
         #self.mystart = numpy.array([g[r] for g, r in zip(edges, rank)])
         #self.myend = numpy.array([g[r + 1] for g, r in zip(edges, rank)])
 
-    def decompose(self, pos, smoothing=0, transform=None):
+    def decompose(self, pos, smoothing=0, transform=None, nonblocking=False):
         """ 
         Decompose particles into domains.
 
@@ -315,6 +370,10 @@ class GridND(object):
             transform is needed if pos and the domain edges are of different units.
             For example, pos in physical simulation units and domain edges on a mesh unit.
 
+        nonblocking : boolean
+            If True, return before the exchange of counts has completed;
+            see :py:meth:`Layout.wait`.
+
         Returns
         -------
         layout :  :py:class:`Layout` object that can be used to exchange data
@@ -346,11 +405,11 @@ class GridND(object):
                 chunk = transform(pos[s])
                 for j in range(self.ndim):
                     if periodic:
-                        tmp = numpy.remainder(chunk[:, j], self.edges[j][-1])
+                        tmp = numpy.remainder(chunk[:, j], self._edges[j][-1])
                     else:
                         tmp = chunk[:, j]
-                    sil[j, s] = self._digitize(tmp - smoothing[j], self.edges[j]) - 1
-                    sir[j, s] = self._digitize(tmp + smoothing[j], self.edges[j])
+                    sil[j, s] = self._digitize(tmp - smoothing[j], self._edges[j]) - 1
+                    sir[j, s] = self._digitize(tmp + smoothing[j], self._edges[j])
 
             for j in range(self.ndim):
                 dim = self.shape[j]
@@ -371,7 +430,8 @@ class GridND(object):
                 comm=self.comm,
                 oldlength=Npoint,
                 sendcounts=counts,
-                indices=indices)
+                indices=indices,
+                nonblocking=nonblocking)
 
         return layout
 
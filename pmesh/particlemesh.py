@@ -15,6 +15,22 @@ from mpi4py import MPI
 from .tools import Timers
 from . import domain
 from . import cic, tsc
+try:
+    from . import _cic
+except ImportError:
+    _cic = None
+
+def _broadcast_weights(weights, size):
+    # a scalar weight becomes a zero-stride view; nothing of size is allocated.
+    weights = numpy.asarray(weights, dtype='f8')
+    return numpy.broadcast_to(weights, (size,))
+
+def _concatenate_positions(positions):
+    # join the non-empty sets of positions; None if there are none.
+    positions = [p for p in positions if len(p) > 0]
+    if len(positions) == 0:
+        return None
+    return numpy.concatenate(positions, axis=0)
 
 class ParticleMesh(object):
     """
@@ -71,8 +87,16 @@ class ParticleMesh(object):
     T    : :py:class:`pmesh.tools.Timers`
         profiling timers
 
+    plan_method : string
+        how hard PFFT tries to find a fast plan: 'estimate' (default),
+        'measure', or 'exhaustive'. Planning is done once in the constructor.
+
+    verbose : bool or int
+        if True, print the sum of the real field around every FFT;
+        if an integer N, only on every N-th :py:meth:`r2c`.
+
     """
-    def __init__(self, BoxSize, Nmesh, paintbrush='cic', comm=None, np=None, verbose=False, dtype='f8'):
+    def __init__(self, BoxSize, Nmesh, paintbrush='cic', comm=None, np=None, verbose=False, dtype='f8', plan_method='estimate'):
         """ create a PM object.  """
         # this weird sequence to intialize comm is because
         # we want to be compatible with None comm == MPI.COMM_WORLD
@@ -99,29 +123,63 @@ class ParticleMesh(object):
         self.Nmesh = Nmesh
         self.BoxSize = numpy.empty(3, dtype='f8')
         self.BoxSize[:] = BoxSize
+        # scaling from simulation unit to grid unit; used by transform
+        self.dtype = dtype
+        self._scale = 1.0 * self.Nmesh / self.BoxSize
+        # density normalization, folded into the painted weights
+        self._paint_scale = self.Nmesh ** 3 / self.BoxSize.prod()
+        # PFFT normalization applied by r2c, and the unit of w
+        self._fft_norm = 1.0 / self.Nmesh ** 3
+        self._k_unit = 2 * numpy.pi / self.Nmesh
         self.partition = pfft.Partition(forward,
             [Nmesh, Nmesh, Nmesh], 
             self.procmesh,
             pfft.Flags.PFFT_TRANSPOSED_OUT | pfft.Flags.PFFT_DESTROY_INPUT)
+        self._lstart = self.partition.local_i_start.astype('f8')
+        # single precision copies, used only for f4 positions on a f4 mesh
+        self._scale_f4 = self._scale.astype('f4')
+        self._lstart_f4 = self._lstart.astype('f4')
 
         buffer = pfft.LocalBuffer(self.partition)
         self.real = buffer.view_input()
-        self.real[:] = 0
-
         self.complex = buffer.view_output()
 
+        plan_method = {
+            "estimate": pfft.Flags.PFFT_ESTIMATE,
+            "measure": pfft.Flags.PFFT_MEASURE,
+            "exhaustive": pfft.Flags.PFFT_EXHAUSTIVE,
+            } [plan_method]
+
         self.T = Timers(self.comm)
+        # bind the timers used per step
+        self._T_Decompose = self.T['Decompose']
+        self._T_Paint = self.T['Paint']
+        self._T_R2C = self.T['R2C']
+        self._T_Transfer = self.T['Transfer']
+        self._T_Readout = self.T['Readout']
+        self._T_C2R = self.T['C2R']
         with self.T['Plan']:
             self.forward = pfft.Plan(self.partition, pfft.Direction.PFFT_FORWARD,
                     self.real.base, self.complex.base, forward,
-                    pfft.Flags.PFFT_ESTIMATE | pfft.Flags.PFFT_TRANSPOSED_OUT | pfft.Flags.PFFT_DESTROY_INPUT)
+                    plan_method | pfft.Flags.PFFT_TRANSPOSED_OUT | pfft.Flags.PFFT_DESTROY_INPUT)
             self.backward = pfft.Plan(self.partition, pfft.Direction.PFFT_BACKWARD,
                     self.complex.base, self.real.base, backward, 
-                    pfft.Flags.PFFT_ESTIMATE | pfft.Flags.PFFT_TRANSPOSED_IN | pfft.Flags.PFFT_DESTROY_INPUT)
+                    plan_method | pfft.Flags.PFFT_TRANSPOSED_IN | pfft.Flags.PFFT_DESTROY_INPUT)
+
+        # planning other than estimate overwrites the buffers; clear after it.
+        self.real.fill(0)
 
         self.domain = domain.GridND(self.partition.i_edges, comm=self.comm)
         self.verbose = verbose
-        self.stack = []
+        # report every verbose_every-th r2c; 0 disables the report.
+        self.verbose_every = int(verbose)
+        self._step = 0
+        # buffers backing push / pop; they grow to the deepest push
+        # and are reused afterwards.
+        self._stack_pool = []
+        self._stack_top = 0
+        # size of the blocks of complex that transfer works on
+        self._tile_bytes = 1024 * 1024
 
         k = []
         x = []
@@ -136,13 +194,22 @@ class ParticleMesh(object):
             wi = numpy.arange(s[d], dtype='f4') + self.partition.local_o_start[d] 
             ri = numpy.arange(t[d], dtype='f4') + self.partition.local_i_start[d] 
 
-            wi[wi >= self.Nmesh // 2] -= self.Nmesh
-            ri[ri >= self.Nmesh // 2] -= self.Nmesh
+            # fold [Nmesh // 2, Nmesh) to negative values;
+            # (i + h) % Nmesh - h with h = Nmesh - Nmesh // 2 also holds for odd Nmesh
+            h = self.Nmesh - self.Nmesh // 2
+            for a in (wi, ri):
+                a += h
+                numpy.remainder(a, self.Nmesh, out=a)
+                a -= h
 
-            wi *= (2 * numpy.pi / self.Nmesh)
+            wi *= self._k_unit
             ki = wi * self.Nmesh / self.BoxSize[d]
             xi = ri * self.BoxSize[d] / self.Nmesh
 
+            # these are shared by all transfer functions; protect them.
+            for a in (wi, ri, ki, xi):
+                a.setflags(write=False)
+
             w.append(wi.reshape(s))
             r.append(ri.reshape(t))
             k.append(ki.reshape(s))
@@ -162,6 +229,14 @@ class ParticleMesh(object):
         else:
             raise ValueError("valid `painter` values are: ['cic', 'tsc']")
 
+        # cic kernels specialized for this Nmesh; they write through
+        # a flat view, thus need a contiguous canvas.
+        if _cic is not None and self.real.flags.c_contiguous:
+            self._cic3d = _cic.kernels3d(self.Nmesh)
+        else:
+            self._cic3d = None
+        self._shape = numpy.array(self.real.shape, dtype='intp')
+
     def transform(self, x):
         """ 
         Transform from simulation unit to local grid unit.
@@ -175,9 +250,16 @@ class ParticleMesh(object):
         -------
         ret   : array_like (, ndim)
             coordinates in local grid unit
+
+        Notes
+        -----
+        The arithmetic is done in f4 only if both x and the mesh are f4, otherwise
+        in f8; the dtype of ret is what the painter and readout kernels then work on.
  
         """
-        ret = (1.0 * self.Nmesh / self.BoxSize) * x - self.partition.local_i_start
+        scale, lstart = self._affine(x)
+        ret = numpy.multiply(x, scale)
+        ret -= lstart
         return ret
 
     def transform0(self, x):
@@ -192,12 +274,19 @@ class ParticleMesh(object):
         Returns
         -------
         ret   : array_like (, ndim)
-            coordinates in global grid unit
+            coordinates in global grid unit, of the same dtype as
+            in :py:meth:`transform`.
  
         """
-        ret = (1.0 * self.Nmesh / self.BoxSize) * x
+        scale, lstart = self._affine(x)
+        ret = numpy.multiply(x, scale)
         return ret
 
+    def _affine(self, x):
+        if self.dtype == numpy.dtype('f4') and getattr(x, 'dtype', None) == numpy.dtype('f4'):
+            return self._scale_f4, self._lstart_f4
+        return self._scale, self._lstart
+
     def decompose(self, pos):
         """ 
         Create a domain decompose layout for particles at given
@@ -214,9 +303,34 @@ class ParticleMesh(object):
             layout that can be used to migrate particles and images
         to the correct MPI ranks that hosts the PM local mesh
         """
-        with self.T['Decompose']:
+        with self._T_Decompose:
             return self.domain.decompose(pos, smoothing=1.0,
                     transform=self.transform0)
+
+    def decompose_async(self, pos):
+        """ 
+        Same as :py:meth:`decompose`, but returns before the
+        counts are exchanged between ranks.
+
+        Local work can be done before the layout is used;
+        :py:meth:`domain.Layout.exchange` waits for the exchange
+        to complete.
+
+        Parameters
+        ----------
+        pos    : array_like (, ndim)
+            position of particles in simulation  unit
+
+        Returns
+        -------
+        layout  : :py:class:domain.Layout
+            layout that can be used to migrate particles and images
+        to the correct MPI ranks that hosts the PM local mesh
+        """
+        with self._T_Decompose:
+            return self.domain.decompose(pos, smoothing=1.0,
+                    transform=self.transform0, nonblocking=True)
+
     def clear(self):
         """ 
         Clear the internal real canvas. 
@@ -230,7 +344,7 @@ class ParticleMesh(object):
         a cleared canvas.
     
         """
-        self.real[:] = 0
+        self.real.fill(0)
 
     def paint(self, pos, mass=1.0):
         """ 
@@ -260,10 +374,58 @@ class ParticleMesh(object):
         self.real is the density field (:math:`\\rho(x)`) after this operation. (In units of per cubic distance)
     
         """
-        with self.T['Paint']:
-            self.painter(pos, self.real, weights=mass * (self.Nmesh ** 3 / self.BoxSize.prod()), 
+        self._paint(pos, mass * self._paint_scale)
+
+    def _paint(self, pos, weights):
+        # weights already include the density normalization
+        with self._T_Paint:
+            pos3d = self._cic3d_pos(pos) if self.paintbrush == 'cic' else None
+            if pos3d is not None:
+                pos = pos3d
+                weights = _broadcast_weights(weights, len(pos))
+                scale, lstart = self._affine(pos)
+                self._cic3d[0](pos, self.real.reshape(-1), self._shape,
+                            weights, scale, lstart)
+            else:
+                self.painter(pos, self.real, weights=weights, 
                             mode='ignore', period=self.Nmesh, transform=self.transform)
 
+    def paint_many(self, positions, masses):
+        """ 
+        Paint several sets of particles into the internal real canvas
+        with a single call to the painter.
+
+        The result is the same as calling :py:meth:`paint` on each set,
+        but the per-call overhead is paid only once.
+
+        Parameters
+        ----------
+        positions : list of array_like (, ndim)
+            positions of each set of particles in simulation unit
+
+        masses    : list of scalar or array_like (,)
+            mass of particles in each set, in simulation unit
+
+        """
+        if len(masses) != len(positions):
+            raise ValueError("positions and masses must have the same number of sets")
+
+        pos = _concatenate_positions(positions)
+        if pos is None:
+            return
+
+        if all(numpy.isscalar(m) for m in masses) and len(set(masses)) == 1:
+            weights = masses[0] * self._paint_scale
+        else:
+            # a single weight array, normalized in place
+            weights = numpy.empty(len(pos), dtype='f8')
+            start = 0
+            for p, m in zip(positions, masses):
+                weights[start:start + len(p)] = m
+                start += len(p)
+            weights *= self._paint_scale
+        self._paint(pos, weights)
+
     def r2c(self):
         """ 
         Perform real to complex FFT on the internal canvas.
@@ -277,17 +439,15 @@ class ParticleMesh(object):
 
         """
 
-        if self.verbose:
-            realsum = self.comm.allreduce(self.real.sum(dtype='f8'), MPI.SUM)
-            if self.comm.rank == 0:
-                print('before r2c, sum of real', realsum)
-            self.comm.barrier()
+        self._step += 1
+        if self._sample():
+            self._report_sum('before r2c, sum of real')
 
-        with self.T['R2C']:
+        with self._T_R2C:
             self.forward.execute(self.real.base, self.complex.base)
 
         # PFFT normalization
-        self.complex[:] *= self.Nmesh ** -3
+        self.complex *= self._fft_norm
 
         if self.procmesh.rank == 0:
             # remove the mean !
@@ -302,7 +462,10 @@ class ParticleMesh(object):
         complex field with :py:meth:`pop`.
 
         """
-        self.stack.append(self.complex.copy())
+        if self._stack_top == len(self._stack_pool):
+            self._stack_pool.append(numpy.empty_like(self.complex))
+        numpy.copyto(self._stack_pool[self._stack_top], self.complex)
+        self._stack_top += 1
 
     def pop(self):
         """ 
@@ -311,7 +474,10 @@ class ParticleMesh(object):
         The complex field was saved to an internal stack by :py:meth:`push`. 
 
         """
-        self.complex[:] = self.stack.pop()
+        if self._stack_top == 0:
+            raise IndexError("pop without a matching push")
+        self._stack_top -= 1
+        numpy.copyto(self.complex, self._stack_pool[self._stack_top])
 
     def transfer(self, transfer_functions):
         """ 
@@ -324,12 +490,48 @@ class ParticleMesh(object):
         ----------
         transfer_functions : list of :py:class:transfer.TransferFunction 
             A chain of transfer functions to apply to the complex field. 
+
+        Notes
+        -----
+        Consecutive transfer functions that provide a :code:`factor(w)` method,
+        returning a multiplier that broadcasts against the complex field,
+        are combined and applied in one pass, block by block along the slowest
+        axis in memory; factor then receives w restricted to the block on that axis.
         
         """
 
-        with self.T['Transfer']:
+        with self._T_Transfer:
+            pending = []
             for transfer in transfer_functions:
+                if hasattr(transfer, 'factor'):
+                    pending.append(transfer)
+                    continue
+                self._apply_factors(pending)
+                pending = []
                 transfer(self, self.complex)
+            self._apply_factors(pending)
+
+    def _apply_factors(self, transfer_functions):
+        # apply the product of the factors a few slabs at a time,
+        # keeping each block of complex in cache for the whole chain.
+        # we iterate over the slowest axis to gain locality
+        if len(transfer_functions) == 0:
+            return
+        axis = numpy.argsort(self.complex.strides)[-1]
+        nslabs = self.complex.shape[axis]
+        slabbytes = self.complex.nbytes // max(1, nslabs)
+        nblock = max(1, self._tile_bytes // max(1, slabbytes))
+        for start in range(0, nslabs, nblock):
+            index = [slice(None)] * self.complex.ndim
+            index[axis] = slice(start, start + nblock)
+            index = tuple(index)
+            w = list(self.w)
+            w[axis] = self.w[axis][index]
+            factor = 1.0
+            for transfer in transfer_functions:
+                # w is f4; keep the product in the precision of the mesh
+                factor = factor * numpy.asarray(transfer.factor(w), dtype=self.complex.dtype)
+            self.complex[index] *= factor
 
     def readout(self, pos):
         """ 
@@ -346,11 +548,57 @@ class ParticleMesh(object):
             read out values from the real field.
  
         """
-        with self.T['Readout']:
+        with self._T_Readout:
+            pos3d = self._cic3d_pos(pos) if pos is not None else None
+            if pos3d is not None:
+                pos = pos3d
+                rt = numpy.zeros(len(pos), dtype='f8')
+                scale, lstart = self._affine(pos)
+                self._cic3d[1](pos, self.real.reshape(-1), self._shape,
+                            rt, scale, lstart)
+                return rt
             if pos is not None:
                 rt = cic.readout(self.real, pos, mode='ignore', period=self.Nmesh,
                         transform=self.transform)
                 return rt
+
+    def _cic3d_pos(self, pos):
+        # pos as taken by the specialized cic kernels, or None if they
+        # cannot be used; the kernels do not check bounds.
+        if self._cic3d is None:
+            return None
+        pos = numpy.asarray(pos)
+        if pos.size == 0:
+            pos = pos.reshape(0, 3)
+        if pos.ndim != 2 or pos.shape[1] != 3:
+            return None
+        return pos
+
+    def readout_many(self, positions):
+        """ 
+        Read out from real field at several sets of positions
+        with a single call to the readout kernel.
+
+        Parameters
+        ----------
+        positions : list of array_like (, ndim)
+            positions of each set of particles in simulation unit
+
+        Returns
+        -------
+        rt     : list of array_like (,)
+            read out values for each set; views into a single array.
+
+        """
+        if len(positions) == 0:
+            return []
+        offsets = numpy.cumsum([len(p) for p in positions], dtype='intp')
+        pos = _concatenate_positions(positions)
+        if pos is None:
+            rt = numpy.zeros(0, dtype='f8')
+        else:
+            rt = self.readout(pos)
+        return numpy.split(rt, offsets[:-1])
         
     def c2r(self, transfer_functions=[]):
         """ 
@@ -364,12 +612,19 @@ class ParticleMesh(object):
         """
         self.transfer(transfer_functions)
 
-        with self.T['C2R']:
+        with self._T_C2R:
             self.backward.execute(self.complex.base, self.real.base)
 
-        if self.verbose:
-            realsum = self.comm.allreduce(self.real.sum(dtype='f8'), MPI.SUM)
-            if self.comm.rank == 0:
-                print('after c2r, sum of real', realsum)
-            self.comm.barrier()
+        if self._sample():
+            self._report_sum('after c2r, sum of real')
+
+    def _sample(self):
+        return self.verbose_every > 0 and self._step % self.verbose_every == 0
+
+    def _report_sum(self, message):
+        # native buffer Allreduce avoids pickling the scalar
+        realsum = numpy.array([self.real.sum(dtype='f8')])
+        self.comm.Allreduce(MPI.IN_PLACE, realsum, op=MPI.SUM)
+        if self.comm.rank == 0:
+            print(message, realsum[0])
 
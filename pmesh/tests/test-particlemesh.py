@@ -1,5 +1,5 @@
 from pmesh.particlemesh import ParticleMesh
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_raises
 from runtests.mpi import MPITest
 
 @MPITest(commsize=1)
@@ -24,3 +24,83 @@ def test_xkrw(comm):
         # be 2 // 2 + 1 == 2
         assert(pm.k[i].shape[i] == 2)
         assert(pm.w[i].shape[i] == 2)
+
+@MPITest(commsize=1)
+def test_paint_readout_many(comm):
+    import numpy
+    pm = ParticleMesh(10.0, 4, comm=comm)
+    pos1 = numpy.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+    pos2 = numpy.array([[7.0, 8.0, 9.0]])
+
+    pm.paint(pos1, 1.0)
+    pm.paint(pos2, numpy.array([2.0]))
+    expected = pm.real.copy()
+    pm.clear()
+    pm.paint_many([pos1, pos2], [1.0, numpy.array([2.0])])
+    assert_allclose(pm.real, expected)
+
+    rt1, rt2 = pm.readout_many([pos1, pos2])
+    assert_allclose(rt1, pm.readout(pos1))
+    assert_allclose(rt2, pm.readout(pos2))
+
+    # empty sets contribute nothing and read out empty arrays
+    empty = numpy.empty((0, 3))
+    pm.clear()
+    pm.paint_many([empty, pos1, pos2], [3.0, 1.0, numpy.array([2.0])])
+    pm.paint_many([], [])
+    assert_allclose(pm.real, expected)
+
+    rt0, rt1 = pm.readout_many([empty, pos1])
+    assert len(rt0) == 0
+    assert_allclose(rt1, pm.readout(pos1))
+    assert pm.readout_many([]) == []
+
+    # every set needs a mass
+    assert_raises(ValueError, pm.paint_many, [pos1, pos1], [numpy.ones(2)])
+    assert_raises(ValueError, pm.paint_many, [pos1, pos1], [1.0])
+
+@MPITest(commsize=1)
+def test_transfer_fused(comm):
+    import numpy
+    from pmesh.transfer import TransferFunction
+    pm = ParticleMesh(10.0, 4, comm=comm)
+    pm.real[...] = numpy.random.uniform(size=pm.real.shape)
+    pm.r2c()
+    chain = [TransferFunction.Gaussian(1.0),
+             TransferFunction.Poisson,
+             TransferFunction.SuperLanzcos(1),
+             TransferFunction.Constant(2.0),
+             TransferFunction.Laplace]
+
+    expected = pm.complex.copy()
+    for transfer in chain:
+        transfer(pm, expected)
+
+    # one slab per block, such that the chain is applied in several blocks
+    pm._tile_bytes = 1
+    pm.transfer(chain)
+    assert_allclose(pm.complex, expected, rtol=1e-12)
+
+@MPITest(commsize=1)
+def test_paint_readout_specialized(comm):
+    import numpy
+    from pmesh import cic
+    pm = ParticleMesh(10.0, 4, comm=comm)
+    numpy.random.seed(1234)
+    pos = numpy.random.uniform(0, 10.0, size=(100, 3))
+
+    pm.paint(pos, 2.0)
+    expected = numpy.zeros_like(pm.real)
+    cic.paint_old(pos, expected, weights=2.0 * pm._paint_scale,
+            mode='ignore', period=pm.Nmesh, transform=pm.transform)
+    assert_allclose(pm.real, expected)
+
+    expected = cic.readout_old(pm.real, pos,
+            mode='ignore', period=pm.Nmesh, transform=pm.transform)
+    assert_allclose(pm.readout(pos), expected)
+
+    # empty input is accepted as having no particles
+    real = pm.real.copy()
+    pm.paint([])
+    assert_allclose(pm.real, real)
+    assert len(pm.readout([])) == 0
@@ -150,3 +150,31 @@ def test_exchange_smooth(comm):
     assert_array_equal(npos[0], [[0, 0], [0, 1], [1, 0], [1, 1]])
     assert_array_equal(npos[1], [[0, 0], [0, 1], [1, 0], [1, 1]])
 
+
+@MPITest(commsize=2)
+def test_exchange_nonblocking(comm):
+    DomainGrid = [[0, 1, 2], [0, 2]]
+
+    dcop = domain.GridND(DomainGrid, 
+            comm=comm,
+            periodic=True)
+
+    if comm.rank == 0:
+        pos = numpy.array(list(numpy.ndindex((2, 2))), dtype='f8')
+        mass = [0, 1, 2, 3]
+    else:
+        pos = numpy.empty((0, 2), dtype='f8')
+        mass = []
+
+    layout = dcop.decompose(pos, smoothing=0, nonblocking=True)
+    # reading the counts completes the layout
+    assert layout.newlength == 2
+    npos = layout.exchange(pos)
+    assert layout.wait() is layout
+    npos = comm.allgather(npos)
+    assert_array_equal(npos[0], [[0, 0], [0, 1]])
+    assert_array_equal(npos[1], [[1, 0], [1, 1]])
+
+    nmass = layout.exchange(mass)
+    mass2 = layout.gather(nmass)
+    assert_array_equal(mass2, mass)
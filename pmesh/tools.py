@@ -30,6 +30,7 @@ def FromRoot(comm):
     return decorator
 
 class Timer(object):
+    __slots__ = ['comm', 't0', 'spent']
     def __init__(self, comm):
         self.comm = comm
         self.t0 = 1.0 * MPI.Wtime()
@@ -43,9 +44,11 @@ class Timer(object):
 class Timers(dict):
     def __init__(self, comm=None):
         self.comm = comm
-    def __getitem__(self, key):
-        if not dict.__contains__(self, key):
-            self[key] = Timer(self.comm)
-        return dict.__getitem__(self, key)
+    def __missing__(self, key):
+        # only called for new keys; lookups of existing timers
+        # stay in dict.__getitem__
+        timer = Timer(self.comm)
+        self[key] = timer
+        return timer
     def __str__(self):
         return '\n'.join(['%s: %g' % (key, self[key].spent) for key in self])
@@ -26,6 +26,10 @@ class TransferFunction:
         the output of Poisson introduces a dimension to rho_k!
         the output of SuperLanzcos introduces a dimension to rho_k!
 
+        multiplicative functions also provide a factor(w) attribute
+        returning the multiplier; pm.transfer then combines consecutive
+        ones and sweeps the complex field only once.
+
         w is a tuple of (w0, w1, w2, ...)
         w is in circular frequency units. The dimensionful k is w * Nmesh / BoxSize 
         (nyquist is at about w = pi)
@@ -52,8 +56,9 @@ class TransferFunction:
         if found:
             ind = tuple(ind)
             value = numpy.abs(complex[ind])
-        value = comm.allreduce(value, MPI.SUM)
-        complex[:] /= value
+        value = numpy.array([value], dtype='f8')
+        comm.Allreduce(MPI.IN_PLACE, value, op=MPI.SUM)
+        complex[:] /= value[0]
     @staticmethod
     def RemoveDC(pm, complex):
         w = pm.w
@@ -92,6 +97,12 @@ class TransferFunction:
                 complex *= wi * 1j
             else:
                 complex[:] *= tmp * 1j
+        def factor(w):
+            wi = w[dir] * 1.0
+            if order == 0:
+                return wi * 1j
+            return 1 / 6.0 * (8 * numpy.sin (wi) - numpy.sin (2 * wi)) * 1j
+        SuperLanzcosDir.factor = factor
         return SuperLanzcosDir
     @staticmethod
     def Gaussian(smoothing):
@@ -109,6 +120,13 @@ class TransferFunction:
             for wi in w:
                 wi2 = wi ** 2
                 complex *= numpy.exp(-0.5 * wi2 * sm2)
+        def factor(w):
+            # the terms are evaluated in f4 as above, but multiplied in f8
+            f = 1.0
+            for wi in w:
+                f = f * numpy.exp(-0.5 * wi ** 2 * sm2).astype('f8')
+            return f
+        GaussianS.factor = factor
         return GaussianS
     @staticmethod
     def Constant(C):
@@ -116,6 +134,7 @@ class TransferFunction:
             w = pm.w
             comm = pm.comm
             complex *= C
+        Constant.factor = lambda w: C
         return Constant
     @staticmethod
     def Inspect(name, *indices):
@@ -159,7 +178,7 @@ class TransferFunction:
                 scratch[singular] *= 0.5
 
                 wsum = numpy.bincount(dig, weights=scratch.flat, minlength=wout.size + 2)[1: -1]
-                wsum = comm.allreduce(wsum, MPI.SUM)
+                comm.Allreduce(MPI.IN_PLACE, wsum, op=MPI.SUM)
 
                 # take the sum of weights
                 scratch[...] = 1.0
@@ -167,7 +186,8 @@ class TransferFunction:
                 scratch[singular] = 0.5
 
                 N1 = numpy.bincount(dig, weights=scratch.flat, minlength=wout.size + 2)[1: -1]
-                N += comm.allreduce(N1, MPI.SUM)
+                comm.Allreduce(MPI.IN_PLACE, N1, op=MPI.SUM)
+                N += N1
 
                 # take the sum of power
                 numpy.abs(complex[row], out=scratch)
@@ -176,7 +196,8 @@ class TransferFunction:
                 scratch[singular] *= 0.5
 
                 P1 = numpy.bincount(dig, weights=scratch.flat, minlength=wout.size + 2)[1: -1]
-                P += comm.allreduce(P1, MPI.SUM)
+                comm.Allreduce(MPI.IN_PLACE, P1, op=MPI.SUM)
+                P += P1
 
             psout[:] = P / N 
             wout[:] = wsum / N
@@ -187,7 +208,7 @@ class TransferFunction:
         """ 
             Take the Laplacian k-space: complex *= -w2
 
-            where this function performs only the -w **-2 part.
+            where this function performs only the -w ** 2 part.
 
             Note that k = w * Nmesh / BoxSize, thus the usual laplacian is
            
@@ -200,9 +221,8 @@ class TransferFunction:
             w2 = w[0][row] ** 2
             for wi in w[1:]:
                 w2 = w2 + wi[0] ** 2
-            w2[w2 == 0] = numpy.inf
             w2 *= -1
-        complex[:] *= w2
+            complex[row] *= w2
 
     @staticmethod
     def Poisson(pm, complex):
@@ -239,6 +259,25 @@ class TransferFunction:
             w2 *= -1
             complex[row] /= w2
 
+def _w2(w):
+    # w ** 2 summed over directions, evaluated in f4 as in the
+    # row by row loops above, returned in f8.
+    w2 = w[0] ** 2
+    for wi in w[1:]:
+        w2 = w2 + wi ** 2
+    return w2.astype('f8')
+
+def _laplace_factor(w):
+    return -_w2(w)
+
+def _poisson_factor(w):
+    w2 = _w2(w)
+    w2[w2 == 0] = numpy.inf
+    return -1.0 / w2
+
+TransferFunction.Laplace.factor = _laplace_factor
+TransferFunction.Poisson.factor = _poisson_factor
+
 if __name__ == '__main__':
     def test():
         complex = numpy.ones((2, 3))